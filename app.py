@@ -1,20 +1,45 @@
-from flask import Flask, request, send_file, jsonify, render_template
+from flask import Flask, Request, request, send_file, jsonify, render_template
+import io
 import os
 import uuid
-from compress_image import compress_image
+from compress_image import compress_image, compress_image_alternative, can_encode
+
+class InMemoryUploadRequest(Request):
+    """Request that keeps uploaded files in memory instead of spooling them to disk"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Uploads are capped by MAX_CONTENT_LENGTH, so a BytesIO is always small
+        # enough and saves Werkzeug's write to and read back from a temp file
+        return io.BytesIO()
 
 app = Flask(__name__)
+app.request_class = InMemoryUploadRequest
 
 # Configure folders
-UPLOAD_FOLDER = 'static/uploads'
 DOWNLOAD_FOLDER = 'static/downloads'
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['DOWNLOAD_FOLDER'] = DOWNLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10MB max file size
 
+# Behind nginx/apache, let the proxy send downloads itself via X-Sendfile
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+
+# Pillow format and MIME type for each output extension, in order of preference
+OUTPUT_FORMATS = {
+    '.avif': ('AVIF', 'image/avif'),
+    '.webp': ('WEBP', 'image/webp'),
+    '.jpg': ('JPEG', 'image/jpeg'),
+}
+
+def negotiate_output_format(accept_mimetypes):
+    """Pick the smallest output format the client accepts and Pillow can encode"""
+    # Only explicitly listed types with q > 0 count, so */* still gets JPEG
+    accepted = {mimetype.lower() for mimetype, quality in accept_mimetypes if quality > 0}
+    for extension, (output_format, mimetype) in OUTPUT_FORMATS.items():
+        if output_format == 'JPEG' or (mimetype in accepted and can_encode(output_format)):
+            return output_format, extension
+
 @app.route('/')
 def index():
     """Serve the main page"""
@@ -30,6 +55,7 @@ def upload_file():
             
         file = request.files['file']
         quality = float(request.form.get('quality', 80))
+        mode = request.values.get('mode', 'jpeg')
         
         # Validate file selection
         if file.filename == '':
@@ -43,32 +69,38 @@ def upload_file():
             return jsonify({'error': 'Invalid file type. Please use JPG, PNG, WebP, BMP, or TIFF.'}), 400
         
         if file and file.filename:
-            # Generate unique filenames
-            if not file_extension:
-                file_extension = '.jpg'
-                
-            upload_filename = f"upload_{uuid.uuid4().hex}{file_extension}"
-            download_filename = f"compressed_{uuid.uuid4().hex}.jpg"
+            # Choose the output format from the Accept header
+            output_format, output_extension = negotiate_output_format(request.accept_mimetypes)
             
-            # Save uploaded file
-            upload_path = os.path.join(app.config['UPLOAD_FOLDER'], upload_filename)
-            file.save(upload_path)
+            # Generate unique filename
+            download_filename = f"compressed_{uuid.uuid4().hex}{output_extension}"
             
-            # Get original file size
-            original_size = os.path.getsize(upload_path)
+            # Get original file size from the upload stream itself
+            file.stream.seek(0, os.SEEK_END)
+            original_size = file.stream.tell()
+            file.stream.seek(0)
             
             # Compress image
             download_path = os.path.join(app.config['DOWNLOAD_FOLDER'], download_filename)
             
             try:
-                compress_image(upload_path, quality, download_path)
+                # Decode straight from the upload stream and encode into memory,
+                # so the original never round-trips through disk
+                buffer = io.BytesIO()
                 
-                # Get compressed file size
-                compressed_size = os.path.getsize(download_path)
-                compression_ratio = ((original_size - compressed_size) / original_size) * 100
+                # Plain re-encoding by default, PCA only when asked for
+                if mode == 'pca':
+                    compress_image(file.stream, quality, buffer, output_format)
+                else:
+                    compress_image_alternative(file.stream, quality, buffer, output_format)
+                
+                # Write the compressed image in a single call
+                with open(download_path, 'wb') as f:
+                    f.write(buffer.getbuffer())
                 
-                # Clean up uploaded file
-                os.remove(upload_path)
+                # Get compressed file size from the in-memory buffer
+                compressed_size = buffer.getbuffer().nbytes
+                compression_ratio = ((original_size - compressed_size) / original_size) * 100
                 
                 return jsonify({
                     'success': True,
@@ -81,9 +113,6 @@ def upload_file():
                 }), 200
                 
             except Exception as compression_error:
-                # Clean up uploaded file on compression error
-                if os.path.exists(upload_path):
-                    os.remove(upload_path)
                 print(f"Compression error: {str(compression_error)}")
                 return jsonify({'error': 'Failed to compress image. Please try again.'}), 500
             
@@ -101,12 +130,15 @@ def download_file(filename):
         if not os.path.exists(file_path):
             return jsonify({'error': 'File not found'}), 404
             
-        # Send file with proper filename
+        # Send file with proper filename and content type
+        extension = os.path.splitext(filename)[1].lower()
+        mimetype = OUTPUT_FORMATS.get(extension, ('JPEG', 'image/jpeg'))[1]
+        
         return send_file(
             file_path, 
             as_attachment=True, 
             download_name=f'compressed_{filename}',
-            mimetype='image/jpeg'
+            mimetype=mimetype
         )
         
     except Exception as e:
@@ -137,4 +169,5 @@ if __name__ == '__main__':
     print("Starting Image Compression Server...")
     print("Server will be available at: http://localhost:5000")
     print("Make sure to place index.html in the templates/ folder")
+    print("For production, run: gunicorn wsgi:app")
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
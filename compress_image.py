@@ -1,25 +1,279 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import scipy.linalg
 from PIL import Image
-from sklearn.decomposition import PCA
+from sklearn.utils.extmath import randomized_svd
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional, fall back to plain numpy
+    njit = None
+
+# Up to this many components, reconstruction uses the fused Numba kernel;
+# beyond it a BLAS GEMM is faster
+FUSED_RECONSTRUCT_MAX_COMPONENTS = 32
+
+# LRU cache of fitted principal axes, one entry per image holding every channel,
+# keyed by (image digest, H, W, n_components) and bounded by the bytes held.
+# The budget fits a 12MP photo at quality 80 (about 110MB of axes)
+COMPONENTS_CACHE_MAX_BYTES = 128 * 1024 * 1024
+_components_cache = OrderedDict()
+_components_cache_bytes = 0
+_components_cache_lock = threading.Lock()
+
+def _open_rgb(image_path, scale=1):
+    """
+    Open an image and return it in RGB mode, along with its full size
+    
+    With scale > 1, draft() lets libjpeg decode JPEGs at 1/2, 1/4 or 1/8
+    resolution directly, which skips most of the IDCT work. The result is
+    at least 1/scale of the full size, so callers still resize to their
+    exact target.
+    """
+    img = Image.open(image_path)
+    full_size = img.size
+    if scale > 1:
+        img.draft('RGB', (max(1, img.width // scale), max(1, img.height // scale)))
+    
+    # Convert to RGB if not already (handles RGBA, P, L, etc.)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    
+    return img, full_size
+
+if njit is not None:
+    # Numba's default workqueue threading layer aborts the process when two
+    # threads launch parallel kernels at once (e.g. two gthread requests in
+    # one gunicorn worker), so kernel launches are serialized
+    _kernel_lock = threading.Lock()
+    
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _clip_cast_kernel(values, out):
+        """Kernel behind _clip_cast; must be called under _kernel_lock"""
+        flat_values = values.reshape(-1)
+        flat_out = out.reshape(-1)
+        for i in prange(flat_values.size):
+            value = flat_values[i]
+            if value < 0:
+                value = 0.0
+            elif value > 255:
+                value = 255.0
+            flat_out[i] = value
+    
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _pca_reconstruct_kernel(coefficients, components, channel_mean, out):
+        """Kernel behind _pca_reconstruct; must be called under _kernel_lock"""
+        height, n_components = coefficients.shape
+        width = components.shape[1]
+        for i in prange(height):
+            row = channel_mean.copy()
+            for r in range(n_components):
+                coefficient = coefficients[i, r]
+                for j in range(width):
+                    row[j] += coefficient * components[r, j]
+            for j in range(width):
+                value = row[j]
+                if value < 0:
+                    value = 0.0
+                elif value > 255:
+                    value = 255.0
+                out[i, j] = value
+    
+    def _clip_cast(values, out):
+        """Clip float values to [0, 255] and narrow them into uint8 out in one pass"""
+        with _kernel_lock:
+            _clip_cast_kernel(values, out)
+    
+    def _pca_reconstruct(coefficients, components, channel_mean, out):
+        """
+        Compute coefficients @ components + channel_mean, clipped into uint8 out
+        
+        Each output row is accumulated in a small scratch row and written
+        once, so the (H, W) float reconstruction is never materialized.
+        """
+        with _kernel_lock:
+            _pca_reconstruct_kernel(coefficients, components, channel_mean, out)
+else:
+    def _clip_cast(values, out):
+        """Clip float values to [0, 255] and narrow them into uint8 out"""
+        np.clip(values, 0, 255, out=values)
+        out[...] = values
+
+def can_encode(output_format):
+    """Return True if this Pillow build can write output_format (e.g. 'WEBP', 'AVIF')"""
+    Image.init()
+    return output_format in Image.SAVE
+
+def _save_compressed(img, output_path, quality_percentage, output_format):
+    """
+    Encode img as output_format and return the encoder quality used
+    """
+    encoder_quality = max(10, min(95, int(quality_percentage)))
+    
+    if output_format == 'AVIF':
+        img.save(output_path, 'AVIF', quality=encoder_quality, speed=6)
+    elif output_format == 'WEBP':
+        img.save(output_path, 'WEBP', quality=encoder_quality, method=4)
+    else:
+        img.save(output_path, 'JPEG', quality=encoder_quality, optimize=True,
+                 progressive=False, subsampling=2)
+    
+    return encoder_quality
+
+def _downsample_factor(quality_percentage):
+    """
+    Factor to shrink the image by before PCA at low quality settings
+    
+    Keeping only a few components is already a heavy low-pass filter, so
+    decomposing a smaller image loses little and cuts the SVD work by the
+    square of the factor.
+    """
+    if quality_percentage < 15:
+        return 4
+    if quality_percentage < 30:
+        return 2
+    return 1
+
+def _fit_components(channel_centered, n_components, max_components):
+    """
+    Find the top principal axes of a centered channel
+    
+    Args:
+        channel_centered (np.ndarray): (H, W) column-centered float32 channel
+        n_components (int): Number of components to keep
+        max_components (int): min(H, W)
+    
+    Returns:
+        np.ndarray: (n_components, W) array of principal axes
+    """
+    height, width = channel_centered.shape
+    
+    if n_components < max_components // 4:
+        # Few components: randomized SVD only computes what we keep
+        _, _, components = randomized_svd(channel_centered, n_components=n_components,
+                                          n_oversamples=10, n_iter=2, random_state=0)
+    elif height > 2 * width:
+        # Tall image: the principal axes are the top eigenvectors of the
+        # small (W, W) covariance, which costs one GEMM plus a cheap eigh
+        # (only the kept eigenpairs are computed) instead of a full SVD
+        _, V = scipy.linalg.eigh(channel_centered.T @ channel_centered,
+                                 subset_by_index=[width - n_components, width - 1],
+                                 overwrite_a=True, check_finite=False)
+        components = V[:, ::-1].T
+    elif width > 2 * height:
+        # Wide image: eigendecompose the (H, H) Gram matrix instead and map
+        # its eigenvectors (the left singular vectors) onto the principal axes
+        eigenvalues, U = scipy.linalg.eigh(channel_centered @ channel_centered.T,
+                                           subset_by_index=[height - n_components, height - 1],
+                                           overwrite_a=True, check_finite=False)
+        U = U[:, ::-1]
+        singular_values = np.sqrt(np.maximum(eigenvalues[::-1], 0))[:, np.newaxis]
+        
+        # Drop numerically null directions rather than amplifying noise
+        keep = singular_values > singular_values[0] * 1e-4
+        components = np.divide(U.T @ channel_centered, singular_values,
+                               out=np.zeros((n_components, width), dtype=np.float32), where=keep)
+    else:
+        # Direct LAPACK gesdd call; channel_centered is still needed for the
+        # projection, so it must not be overwritten
+        _, _, Vt = scipy.linalg.svd(channel_centered, full_matrices=False,
+                                    lapack_driver='gesdd', check_finite=False)
+        components = Vt[:n_components]
+    
+    return components
 
-def compress_image(image_path, quality_percentage, output_path):
+def _get_cached_components(cache_key):
+    """
+    Return the cached per-channel principal axes for cache_key, or None
+    
+    Re-uploading the same image at the same quality reuses the axes and
+    skips the decomposition entirely.
+    """
+    with _components_cache_lock:
+        channel_components = _components_cache.get(cache_key)
+        if channel_components is not None:
+            _components_cache.move_to_end(cache_key)
+        return channel_components
+
+def _store_cached_components(cache_key, channel_components):
+    """Cache the principal axes of every channel of one image"""
+    global _components_cache_bytes
+    
+    # The solvers may return views on larger arrays (e.g. the first k rows of
+    # Vt); own the data so nbytes is what the cache actually holds
+    channel_components = tuple(components if components.base is None else components.copy()
+                               for components in channel_components)
+    entry_bytes = sum(components.nbytes for components in channel_components)
+    
+    # An image larger than the whole budget would just evict everything else
+    if entry_bytes > COMPONENTS_CACHE_MAX_BYTES:
+        return
+    
+    with _components_cache_lock:
+        if cache_key not in _components_cache:
+            _components_cache[cache_key] = channel_components
+            _components_cache_bytes += entry_bytes
+        _components_cache.move_to_end(cache_key)
+        while _components_cache_bytes > COMPONENTS_CACHE_MAX_BYTES:
+            _, evicted = _components_cache.popitem(last=False)
+            _components_cache_bytes -= sum(components.nbytes for components in evicted)
+
+def _project_channel(channel_data, n_components, max_components, components=None):
+    """
+    Project a single channel onto its top principal components
+    
+    Args:
+        channel_data (np.ndarray): (H, W) C-contiguous float32 channel, overwritten
+        n_components (int): Number of components to keep
+        max_components (int): min(H, W)
+        components (np.ndarray): Cached principal axes, or None to fit them
+    
+    Returns:
+        tuple: (coefficients, components, channel_mean), where
+        coefficients @ components + channel_mean reconstructs the channel
+    """
+    # Center the channel column-wise, as PCA does. channel_data is a
+    # contiguous float32 scratch copy, so it is centered in place
+    channel_mean = channel_data.mean(axis=0)
+    channel_centered = channel_data
+    channel_centered -= channel_mean
+    
+    if components is None:
+        components = _fit_components(channel_centered, n_components, max_components)
+    
+    return channel_centered @ components.T, components, channel_mean
+
+def compress_image(image_path, quality_percentage, output_path, output_format='JPEG'):
     """
     Compress image using PCA while preserving RGB colors
     
     Args:
-        image_path (str): Path to input image
+        image_path (str or file-like): Path to input image, or an open binary stream
         quality_percentage (float): Quality percentage (10-100)
-        output_path (str): Path to save compressed image
+        output_path (str or file-like): Path to save compressed image, or a writable binary stream
+        output_format (str): Pillow format to encode as: 'JPEG', 'WEBP' or 'AVIF'
     """
     try:
-        # Load image and convert to RGB (handles all formats)
-        img = Image.open(image_path)
+        # Load image and convert to RGB (handles all formats).
+        # At low quality, run PCA on a downsampled copy; it is scaled back
+        # to the original dimensions before encoding. JPEGs are mostly
+        # downsampled by libjpeg while decoding
+        scale = _downsample_factor(quality_percentage)
+        img, output_size = _open_rgb(image_path, scale)
         
-        # Convert to RGB if not already (handles RGBA, P, L, etc.)
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
+        if scale > 1:
+            pca_size = (max(1, output_size[0] // scale), max(1, output_size[1] // scale))
+            if img.size != pca_size:
+                img = img.resize(pca_size, Image.LANCZOS)
         
-        img_array = np.array(img)
+        # Decode now, then view the pixels with asarray, which avoids the
+        # extra copy np.array makes; img_array is read-only from here on
+        img.load()
+        img_array = np.asarray(img)
         original_shape = img_array.shape
         
         # Get image dimensions
@@ -31,43 +285,88 @@ def compress_image(image_path, quality_percentage, output_path):
         n_components = max(1, int(max_components * quality_percentage / 100))
         n_components = min(n_components, max_components)
         
-        # Process each color channel separately
-        compressed_channels = []
-        
-        for channel in range(channels):
-            # Extract single channel
-            channel_data = img_array[:, :, channel]
+        if n_components >= max_components * 0.9:
+            # Keeping nearly every component reproduces the original, so
+            # skip the decomposition and let JPEG do the work
+            img_compressed_array = img_array
+        else:
+            # Arrange the channels as a C-contiguous float32 (3, H, W) stack so
+            # each channel hits the single-precision LAPACK routines without
+            # further copies or upcasts
+            channel_stack = np.ascontiguousarray(img_array.transpose(2, 0, 1), dtype=np.float32)
             
-            # Apply PCA to this channel
-            pca = PCA(n_components=n_components)
+            # Identical pixels at the same quality share their principal axes
+            image_digest = hashlib.blake2b(img_array, digest_size=16).digest()
+            cache_key = (image_digest, height, width, n_components)
+            cached_components = _get_cached_components(cache_key)
             
-            # Fit and transform
-            channel_reduced = pca.fit_transform(channel_data)
+            # The SVDs run in LAPACK, which releases the GIL, so the
+            # channels are decomposed concurrently
+            with ThreadPoolExecutor(max_workers=channels) as executor:
+                projections = list(executor.map(
+                    lambda channel: _project_channel(
+                        channel_stack[channel], n_components, max_components,
+                        cached_components[channel] if cached_components is not None else None),
+                    range(channels)))
             
-            # Inverse transform to reconstruct
-            channel_reconstructed = pca.inverse_transform(channel_reduced)
+            if cached_components is None:
+                _store_cached_components(cache_key, [components for _, components, _ in projections])
             
-            # Ensure values are in valid range [0, 255]
-            channel_reconstructed = np.clip(channel_reconstructed, 0, 255)
+            # Reconstruct as PCA's inverse_transform does, ensuring values are
+            # in valid range [0, 255] and converting back to uint8
+            img_uint8_array = np.empty((height, width, channels), dtype=np.uint8)
             
-            compressed_channels.append(channel_reconstructed)
-        
-        # Stack channels back together
-        img_compressed_array = np.stack(compressed_channels, axis=2)
-        
-        # Convert back to uint8
-        img_compressed_array = img_compressed_array.astype(np.uint8)
+            if njit is not None and n_components <= FUSED_RECONSTRUCT_MAX_COMPONENTS:
+                # Few components: one fused pass per channel straight into uint8
+                for channel, (coefficients, components, channel_mean) in enumerate(projections):
+                    _pca_reconstruct(coefficients, components, channel_mean, img_uint8_array[:, :, channel])
+            else:
+                # Each channel is written straight into its slice of the output,
+                # then clipped and narrowed in a single pass
+                img_float_array = np.empty((height, width, channels), dtype=np.float32)
+                for channel, (coefficients, components, channel_mean) in enumerate(projections):
+                    np.add(coefficients @ components, channel_mean, out=img_float_array[:, :, channel])
+                _clip_cast(img_float_array, img_uint8_array)
+            
+            img_compressed_array = img_uint8_array
         
         # Create PIL Image from array
         img_compressed = Image.fromarray(img_compressed_array, 'RGB')
         
-        # Save with JPEG compression
+        if img_compressed.size != output_size:
+            img_compressed = img_compressed.resize(output_size, Image.BILINEAR)
+        
+        # Save with JPEG (or WebP/AVIF) compression
         # You can adjust the quality parameter for additional compression
-        jpeg_quality = max(10, min(95, int(quality_percentage)))
-        img_compressed.save(output_path, 'JPEG', quality=jpeg_quality, optimize=True)
+        _save_compressed(img_compressed, output_path, quality_percentage, output_format)
+        
+        print(f"Image compressed successfully: {output_size[0]}x{output_size[1]} -> {output_format}")
+        print(f"PCA shape: {original_shape}, PCA components: {n_components}, output size: {output_size}")
+        
+    except Exception as e:
+        print(f"Error compressing image: {str(e)}")
+        raise e
+
+def compress_image_alternative(image_path, quality_percentage, output_path, output_format='JPEG'):
+    """
+    Compress image by re-encoding it, without the PCA pass
+    
+    The size reduction comes entirely from the (SIMD-accelerated)
+    libjpeg-turbo, libwebp or libavif encoder bundled with Pillow.
+    
+    Args:
+        image_path (str or file-like): Path to input image, or an open binary stream
+        quality_percentage (float): Quality percentage (10-100)
+        output_path (str or file-like): Path to save compressed image, or a writable binary stream
+        output_format (str): Pillow format to encode as: 'JPEG', 'WEBP' or 'AVIF'
+    """
+    try:
+        img, _ = _open_rgb(image_path)
+        
+        encoder_quality = _save_compressed(img, output_path, quality_percentage, output_format)
         
-        print(f"Image compressed successfully: {image_path} -> {output_path}")
-        print(f"Original shape: {original_shape}, PCA components: {n_components}")
+        print(f"Image compressed successfully: {img.width}x{img.height} -> {output_format}")
+        print(f"{output_format} quality: {encoder_quality}")
         
     except Exception as e:
         print(f"Error compressing image: {str(e)}")
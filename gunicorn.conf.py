@@ -0,0 +1,18 @@
+import multiprocessing
+import os
+
+# Workers already use every core, and each request fans out over a
+# 3-thread channel pool, so keep BLAS and Numba single-threaded to avoid
+# oversubscription. This runs in the master, before workers import numpy
+for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMBA_NUM_THREADS'):
+    os.environ.setdefault(variable, '1')
+
+# One worker per core: compression is CPU-bound, so each request gets its own process
+bind = '0.0.0.0:5000'
+workers = multiprocessing.cpu_count()
+worker_class = 'gthread'
+threads = 2
+
+# Recycle workers periodically to keep memory from large images in check
+max_requests = 500
+max_requests_jitter = 50
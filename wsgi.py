@@ -0,0 +1,10 @@
+"""
+WSGI entry point for production
+
+Run with gunicorn (settings are read from gunicorn.conf.py):
+    gunicorn wsgi:app
+"""
+from app import app
+
+if __name__ == '__main__':
+    app.run()